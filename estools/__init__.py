@@ -1,93 +1,108 @@
-from __future__ import print_function
-
 import re
+from collections import defaultdict, namedtuple
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import logging
-from random import shuffle
 
 import curator
-from elasticsearch import Elasticsearch, TransportError, ConflictError, RequestError
+import urllib3
+from elasticsearch import Elasticsearch, TransportError, ConflictError, ConnectionTimeout, RequestError
 
 from estools.should_be_externalized import Nodes, Icinga, RemoteExecutionError
-from estools.utils import wait_for
+from estools.utils import shuffled, wait_for
+
+ClusterSpec = namedtuple('ClusterSpec', 'endpoint suffix dc_name')
 
 elasticsearch_clusters = {
-    'search': {
-        'eqiad': {
-            'endpoint': 'search.svc.eqiad.wmnet:9200',
-            'suffix': 'eqiad.wmnet',
-            'dc_name': 'eqiad',
-        },
-        'codfw': {
-            'endpoint': 'search.svc.codfw.wmnet:9200',
-            'suffix': 'codfw.wmnet',
-            'dc_name': 'codfw',
-        },
-    },
-    'relforge': {
-        'eqiad': {
-            'endpoint': 'relforge1002.eqiad.wmnet:9200',
-            'suffix': 'eqiad.wmnet',
-            'dc_name': 'eqiad',
-        },
-    },
-    'test': {
-        'local': {
-            'endpoint': 'localhost:9200',
-            'suffix': 'codfw.wmnet',
-            'dc_name': 'codfw',
-        },
-    },
+    ('search', 'eqiad'): ClusterSpec('search.svc.eqiad.wmnet:9200', 'eqiad.wmnet', 'eqiad'),
+    ('search', 'codfw'): ClusterSpec('search.svc.codfw.wmnet:9200', 'codfw.wmnet', 'codfw'),
+    ('relforge', 'eqiad'): ClusterSpec('relforge1002.eqiad.wmnet:9200', 'eqiad.wmnet', 'eqiad'),
+    ('test', 'local'): ClusterSpec('localhost:9200', 'codfw.wmnet', 'codfw'),
 }
 
+_WRITE_QUEUE_RE = re.compile(
+    r'^cirrusSearchElasticaWrite: (?P<queued>\d+) queued; (?P<claimed>\d+) claimed \((?P<active>\d+) active, (?P<abandoned>\d+) abandoned\); (?P<delayed>\d+) delayed$',
+    flags=re.M)
+
+# used to check elasticsearch directly on nodes, shared to keep connections alive
+_http_pool = urllib3.PoolManager(num_pools=16, maxsize=16)
+
+
+@lru_cache(maxsize=None)
+def _get_es_client(endpoint, retry_on_timeout=True):
+    """Get the client for an endpoint, shared so that its connection pool is reused.
+
+    Without retry_on_timeout, the client gives up on the first timeout instead
+    of sending the same request again to a cluster that is too slow to answer.
+    """
+    return Elasticsearch(
+        endpoint,
+        maxsize=32,
+        sniff_on_start=False,
+        # elasticsearch-py 5.x has no http_compress option, ask for gzip responses explicitly
+        headers={'accept-encoding': 'gzip,deflate'},
+        timeout=30,
+        retry_on_timeout=retry_on_timeout,
+        max_retries=3,
+    )
 
-class Datacenter(object):
-    def __init__(self, cumin_config, sudo, dry_run=False):
+
+class Datacenter:
+    def __init__(self, cumin_config, sudo, dry_run=False, fake_safe=False):
         self.cumin_config = cumin_config
         self.sudo = sudo
         self.dry_run = dry_run
+        self.fake_safe = fake_safe
+        self._icinga = None
+        self._script_node = None
 
     def icinga(self):
-        return Icinga('icinga.wikimedia.org', self.cumin_config, self.sudo, self.dry_run)
+        if self._icinga is None:
+            self._icinga = Icinga('icinga.wikimedia.org', self.cumin_config, self.sudo, self.dry_run, self.fake_safe)
+        return self._icinga
 
     def script_node(self):
-        return ScriptNode('terbium.eqiad.wmnet', self.cumin_config, self.dry_run, self.icinga())
+        if self._script_node is None:
+            self._script_node = ScriptNode('terbium.eqiad.wmnet', self.cumin_config, self.dry_run, self.icinga(), self.fake_safe)
+        return self._script_node
 
     def elasticsearch_cluster(self, name, site):
         """Create an ElasticsearchCluster object for the given cluster / DC
         :param name: name of the cluster (search, relforge, ...)
         :param site: site in which the cluster is (eqiad, codfw, ...)
 
-        >>> dc = Datacenter(cumin_config={})
+        >>> dc = Datacenter(cumin_config={}, sudo=False)
         >>> c = dc.elasticsearch_cluster('search', 'eqiad')
         >>> c.elasticsearch.transport.hosts
-        [{u'host': u'search.svc.eqiad.wmnet', u'port': 9200}]
+        [{'host': 'search.svc.eqiad.wmnet', 'port': 9200}]
         >>> c = dc.elasticsearch_cluster('test', 'local')
         >>> c.elasticsearch.transport.hosts
-        [{u'host': u'localhost', u'port': 9200}]
-        >>> c = dc.elasticsearch_cluster('search', 'non-existing-site')
+        [{'host': 'localhost', 'port': 9200}]
+        >>> c = dc.elasticsearch_cluster('search', 'non-existing-site')  # doctest: +IGNORE_EXCEPTION_DETAIL
         Traceback (most recent call last):
           ...
         ConfigError: No cluster named search exist in DC non-existing-site
-        >>> c = dc.elasticsearch_cluster('non-existing-cluster', 'eqiad')
+        >>> c = dc.elasticsearch_cluster('non-existing-cluster', 'eqiad')  # doctest: +IGNORE_EXCEPTION_DETAIL
         Traceback (most recent call last):
           ...
         ConfigError: No cluster named non-existing-cluster exist in DC eqiad
         """
         try:
-            endpoint = elasticsearch_clusters[name][site]['endpoint']
-            suffix = elasticsearch_clusters[name][site]['suffix']
-            dc_name = elasticsearch_clusters[name][site]['dc_name']
-            return ElasticsearchCluster(Elasticsearch(endpoint), dc_name, self.script_node(), self.cumin_config, suffix, self.icinga(), self.sudo, self.dry_run)
+            spec = elasticsearch_clusters[(name, site)]
         except KeyError:
             raise ConfigError('No cluster named {name} exist in DC {site}'.format(name=name, site=site))
+        return ElasticsearchCluster(_get_es_client(spec.endpoint), spec.dc_name, self.script_node(), self.cumin_config, spec.suffix, self.icinga(), self.sudo, self.dry_run, self.fake_safe,
+                                    no_retry_elasticsearch=_get_es_client(spec.endpoint, retry_on_timeout=False))
 
 
-class ElasticsearchCluster(object):
-    def __init__(self, elasticsearch, dc_name, script_node, cumin_config, node_suffix, icinga, sudo, dry_run=False):
+class ElasticsearchCluster:
+    def __init__(self, elasticsearch, dc_name, script_node, cumin_config, node_suffix, icinga, sudo, dry_run=False,
+                 fake_safe=False, no_retry_elasticsearch=None):
         self.elasticsearch = elasticsearch
+        # client to the same cluster that does not retry timed out requests
+        self.no_retry_elasticsearch = no_retry_elasticsearch or elasticsearch
         self.dc_name = dc_name
         self.script_node = script_node
         self.cumin_config = cumin_config
@@ -95,7 +110,10 @@ class ElasticsearchCluster(object):
         self.icinga = icinga
         self.sudo = sudo
         self.dry_run = dry_run
+        self.fake_safe = fake_safe
         self.logger = logging.getLogger('estools.cluster')
+        self._row_cache = None
+        self._routing_cache = {}
 
     @contextmanager
     def frozen_writes(self):
@@ -126,9 +144,7 @@ class ElasticsearchCluster(object):
 
     def write_queue_status(self):
         _, message = self.script_node.mwscript('showJobs.php', ['--wiki=enwiki',  '--group'], safe=True)
-        match = re.search(
-            r'^cirrusSearchElasticaWrite: (?P<queued>\d+) queued; (?P<claimed>\d+) claimed \((?P<active>\d+) active, (?P<abandoned>\d+) abandoned\); (?P<delayed>\d+) delayed$',
-            message, flags=re.M)
+        match = _WRITE_QUEUE_RE.search(message)
         if match:
             return {
                 'queued': int(match.group('queued')),
@@ -150,39 +166,63 @@ class ElasticsearchCluster(object):
 
     def _stop_replication(self, wait=True):
         self.logger.info('stop replication')
-        self._do_cluster_routing(
-            curator.ClusterRouting(self.elasticsearch, routing_type='allocation', setting='enable',
-                                   value='primaries', wait_for_completion=wait)
-        )
+        self._do_cluster_routing(self._get_routing('primaries', wait))
 
     def _start_replication(self, wait=True):
         self.logger.info('start replication')
-        self._do_cluster_routing(
-            curator.ClusterRouting(self.elasticsearch, routing_type='allocation', setting='enable',
-                                   value='all', wait_for_completion=wait)
-        )
+        self._do_cluster_routing(self._get_routing('all', wait))
+
+    def _get_routing(self, value, wait):
+        key = (value, wait)
+        if key not in self._routing_cache:
+            self._routing_cache[key] = curator.ClusterRouting(
+                self.elasticsearch, routing_type='allocation', setting='enable',
+                value=value, wait_for_completion=wait)
+        return self._routing_cache[key]
 
     def wait_for_green(self, timeout=timedelta(hours=1), max_delayed_jobs=None):
         self.logger.info('waiting for cluster to be green')
-
-        def green():
-            if max_delayed_jobs:
-                status = self.write_queue_status()
-                if status and status['delayed'] > max_delayed_jobs:
-                    raise MaxWriteQueueExceeded(status)
-            return self.elasticsearch.cluster.health(wait_for_status='green', params={'timeout': '1s'})
-        wait_for(green, retry_period=timedelta(seconds=10), timeout=timeout, ignored_exceptions=[TransportError])
+        self.wait_for_stable(timeout=timeout, require_no_relocations=False, max_delayed_jobs=max_delayed_jobs)
         self.logger.info('cluster is green')
 
     def wait_for_no_relocations(self, timeout=timedelta(minutes=20)):
         self.logger.info('waiting for relocations to stabilize')
-
-        def no_relocations():
-            relocations = self.elasticsearch.indices.recovery(active_only=True)
-            return len(relocations) == 0
-        wait_for(no_relocations, retry_period=timedelta(seconds=10), timeout=timeout, ignored_exceptions=[TransportError])
+        self.wait_for_stable(timeout=timeout, require_green=False)
         self.logger.info('no more relocations in progress')
 
+    def wait_for_stable(self, timeout=timedelta(hours=1), require_green=True, require_no_relocations=True,
+                        max_delayed_jobs=None):
+        """Wait for all the required conditions at once, with a single long polling health request."""
+        wait_params = {'timeout': '30s', 'level': 'cluster'}
+        if require_green:
+            wait_params['wait_for_status'] = 'green'
+        if require_no_relocations:
+            wait_params['wait_for_no_relocating_shards'] = 'true'
+
+        def stable():
+            if max_delayed_jobs:
+                status = self.write_queue_status()
+                if status and status['delayed'] > max_delayed_jobs:
+                    raise MaxWriteQueueExceeded(status)
+            # long poll: elasticsearch blocks for up to 30s until all conditions are met,
+            # a timed out request is answered with a 408 and the current health
+            health = self.elasticsearch.cluster.health(
+                params=dict(wait_params), filter_path='status,relocating_shards,initializing_shards',
+                ignore=408, request_timeout=60)
+            if require_green and health['status'] != 'green':
+                return False
+            if require_no_relocations and (health['relocating_shards'] or health['initializing_shards']):
+                return False
+            return True
+        if require_green:
+            # a green cluster has no initializing shards, the long poll covers every condition
+            periods = {'retry_period': timedelta(seconds=1)}
+        else:
+            # elasticsearch 5 cannot wait for initializing shards to be done, the request returns
+            # as soon as nothing relocates: back off instead of polling every second during recoveries
+            periods = {'initial_period': timedelta(seconds=1), 'max_period': timedelta(seconds=30), 'jitter': False}
+        wait_for(stable, timeout=timeout, ignored_exceptions=[TransportError], **periods)
+
     def wait_for_write_queue_to_drain(self, timeout=timedelta(minutes=20)):
         self.logger.info('waiting for relocations to stabilize')
 
@@ -191,17 +231,35 @@ class ElasticsearchCluster(object):
             return status == {} or status['delayed'] == 0
         wait_for(drained, retry_period=timedelta(seconds=10), timeout=timeout)
 
+    def wait_for_write_queue_empty(self, timeout=timedelta(minutes=1)):
+        self.logger.info('waiting for writes to settle')
+
+        def empty():
+            status = self.write_queue_status()
+            return status == {} or status['active'] + status['queued'] == 0
+        wait_for(empty, timeout=timeout, initial_period=timedelta(seconds=2), max_period=timedelta(seconds=16))
+        self.logger.info('no more active or queued writes')
+
     def flush_markers(self):
         self.logger.info('flush markers')
-        if not self.dry_run:
-            try:
-                self.elasticsearch.indices.flush(force=True, request_timeout=60)
-            except ConflictError:
-                self.logger.exception('Not all shards have been flushed, which should not be an issue.')
-            try:
-                self.elasticsearch.indices.flush_synced(request_timeout=60)
-            except ConflictError:
-                self.logger.exception('Not all shards have been flushed, which should not be an issue.')
+        if self.dry_run:
+            return
+        try:
+            result = self.no_retry_elasticsearch.indices.flush_synced(request_timeout=30)
+            if result['_shards']['failed'] == 0:
+                self.logger.info('synced flush successful on all shards, no forced flush needed')
+                return
+            self.logger.warning('Synced flush failed on some shards, falling back to a forced flush.')
+        except ConflictError:
+            self.logger.warning('Synced flush failed on some shards, falling back to a forced flush.')
+        except ConnectionTimeout:
+            self.logger.warning('Synced flush timed out, falling back to a forced flush.')
+        try:
+            self.no_retry_elasticsearch.indices.flush(force=True, request_timeout=60)
+        except ConflictError:
+            self.logger.exception('Not all shards have been flushed, which should not be an issue.')
+        except ConnectionTimeout:
+            self.logger.warning('Forced flush timed out, which should not be an issue.')
 
     def _do_cluster_routing(self, cluster_routing):
         if self.dry_run:
@@ -210,60 +268,71 @@ class ElasticsearchCluster(object):
             cluster_routing.do_action()
 
     def next_nodes(self, restart_start_time, n=1):
-        info = self.elasticsearch.nodes.info()
-        rows = self._to_rows(info['nodes'], restart_start_time)
-
-        s = sorted(rows.items(), key=lambda row: len(row[1]['done']))
-        for row_name, row in s:
-            if len(row['not_done']) > 0:
-                nodes_names = [node['name'] + '.' + self.node_suffix for node in row['not_done'][:n]]
-                return ElasticNodes(nodes_names, self.cumin_config, self.dry_run, self.icinga, self.sudo)
-        return None
-
-    def _to_rows(self, nodes, start_time):
-        rows = {}
-        for _, node in nodes.items():
-            row = node['attributes']['row']
-            self._ensure_row_initialized(row, rows)
-
-            if self._has_been_restarted_after(node, start_time):
-                rows[row]['done'].append(node)
-            else:
-                rows[row]['not_done'].append(node)
-        return rows
+        start_times = self._jvm_start_times()
+        rows = self._to_rows(self._get_rows_structure(start_times), start_times, restart_start_time)
 
-    def _ensure_row_initialized(self, row, rows):
-        if row not in rows:
-            rows[row] = {'done': [], 'not_done': []}
+        # restart nodes from the row with the fewest restarted nodes that still has some left
+        next_row = min((row for row in rows.values() if row['not_done']), key=lambda row: row['done'], default=None)
+        if next_row is None:
+            return None
+        nodes_names = [name + '.' + self.node_suffix for name in next_row['not_done'][:n]]
+        return ElasticNodes(nodes_names, self.cumin_config, self.dry_run, self.icinga, self.sudo, self.fake_safe)
 
-    def _has_been_restarted_after(self, node, start_time):
-        jvm_start = datetime.utcfromtimestamp(int(node['jvm']['start_time_in_millis'] / 1000))
-        b = jvm_start > start_time
-        return b
+    def _jvm_start_times(self):
+        info = self.elasticsearch.nodes.info(metric='jvm', filter_path='nodes.*.jvm.start_time_in_millis')
+        return {node_id: node['jvm']['start_time_in_millis'] for node_id, node in info['nodes'].items()}
 
-    def force_allocation_of_all_replicas(self):
-        max = len(self.unassigned_shards())
-        i = 0
-        while i < max:
-            unassigned = self.unassigned_shards()
-            if len(unassigned) == 0:
-                # no more unassigned shards, we're done
-                return
-            self.force_allocation_of_shard(unassigned[0])
-            i = i + 1
+    def _get_rows_structure(self, node_ids):
+        """Map node ids to their name and row.
 
-    def unassigned_shards(self):
-        shards = self.elasticsearch.cat.shards(format='json', h='index,shard,state')
-        return [s for s in shards if s['state'] == 'UNASSIGNED']
+        The topology does not change during a restart, so it is only fetched
+        again when unknown nodes show up.
+        """
+        if self._row_cache is None or any(node_id not in self._row_cache for node_id in node_ids):
+            # name and attributes are always part of the nodes info response
+            info = self.elasticsearch.nodes.info(metric='jvm', filter_path='nodes.*.name,nodes.*.attributes.row')
+            self._row_cache = {
+                node_id: (node['name'], node['attributes']['row']) for node_id, node in info['nodes'].items()
+            }
+        return self._row_cache
+
+    def _to_rows(self, topology, start_times, start_time):
+        """Group nodes by row, counting restarted nodes and listing the names of the others."""
+        rows = defaultdict(lambda: {'done': 0, 'not_done': []})
+        start_time_in_millis = int((start_time - datetime(1970, 1, 1)).total_seconds() * 1000)
+        for node_id, node_start_time in start_times.items():
+            name, row = topology[node_id]
+            if node_start_time > start_time_in_millis:
+                rows[row]['done'] += 1
+            else:
+                rows[row]['not_done'].append(name)
+        return rows
 
-    def force_allocation_of_shard(self, shard):
-        if self.is_shard_assigned(shard):
-            self.logger.debug('Shard [%s:%s] is already assigned', shard['index'], shard['shard'])
+    def force_allocation_of_all_replicas(self):
+        # list unassigned shards and nodes once, instead of once per shard
+        unassigned = self.unassigned_shards()
+        if len(unassigned) == 0:
             return
         es_nodes = self.elasticsearch.cat.nodes(h='name').splitlines()
-        # shuffle nodes so that we don't allocate all shards on the same node
-        shuffle(es_nodes)
-        for node in es_nodes:
+        for shard in unassigned:
+            self.force_allocation_of_shard(shard, es_nodes)
+
+    def unassigned_shards(self):
+        # plain text output is much smaller than json, only unassigned lines are parsed
+        shards = self.elasticsearch.cat.shards(h='index,shard,state')
+        unassigned = []
+        for line in shards.splitlines():
+            if 'UNASSIGNED' in line:
+                index, shard, state = line.split()
+                if state == 'UNASSIGNED':
+                    unassigned.append({'index': index, 'shard': shard, 'state': state})
+        return unassigned
+
+    def force_allocation_of_shard(self, shard, es_nodes=None):
+        if es_nodes is None:
+            es_nodes = self.elasticsearch.cat.nodes(h='name').splitlines()
+        # try nodes in random order so that we don't allocate all shards on the same node
+        for node in shuffled(es_nodes):
             try:
                 self.logger.info('Trying to allocate [%s:%s] on [%s]', shard['index'], shard['shard'], node)
                 self.elasticsearch.cluster.reroute(retry_failed=True, body={
@@ -277,21 +346,19 @@ class ElasticsearchCluster(object):
                 # successful allocation, we can exit
                 self.logger.info('allocation successful')
                 return
-            except RequestError:
+            except RequestError as e:
+                # the shard list can be outdated, no other node will do better for a shard assigned since
+                if 'already assigned' in str(e):
+                    self.logger.info('[%s:%s] is already assigned', shard['index'], shard['shard'])
+                    return
                 # error allocating shard, let's try the next node
-                pass
         self.logger.warning('Could not reallocate shard [%s:%s]', shard['index'], shard['shard'])
 
-    def is_shard_assigned(self, shard):
-        shards = self.elasticsearch.cat.shards(index=shard['index'], h='sh,st')
-        match = re.search('{shard}\s*UNASSIGNED'.format(shard=shard['shard']), shards)
-        return match is None
-
 
 class ElasticNodes(Nodes):
 
-    def __init__(self, fqdns, cumin_config, dry_run, icinga, sudo):
-        super(ElasticNodes, self).__init__(fqdns, cumin_config, dry_run, icinga, sudo)
+    def __init__(self, fqdns, cumin_config, dry_run, icinga, sudo, fake_safe=False):
+        super().__init__(fqdns, cumin_config, dry_run, icinga, sudo, fake_safe)
 
     def stop_elasticsearch(self):
         self.stop_service('elasticsearch')
@@ -302,16 +369,27 @@ class ElasticNodes(Nodes):
     def wait_for_elasticsearch(self):
         self.logger.info('waiting for elasticsearch to be up on %s', self)
         wait_for(
-            lambda: self.is_elasticsearch_up(),
+            self.is_elasticsearch_up,
             timeout=timedelta(seconds=300),
-            ignored_exceptions=[RemoteExecutionError]
+            ignored_exceptions=[RemoteExecutionError],
+            initial_period=timedelta(seconds=1),
+            max_period=timedelta(seconds=30)
         )
 
     def is_elasticsearch_up(self):
-        rc, _ = self.execute('curl -s 127.0.0.1:9200/_cat/health', safe=True)
-        if rc != 0:
+        try:
+            up = all(self._local_http_check(fqdn) for fqdn in self.fqdns)
+        except urllib3.exceptions.HTTPError:
+            self.logger.debug('could not reach elasticsearch on %s over http, checking through cumin', self)
+            up = self.execute_rc('curl -s 127.0.0.1:9200/_cat/health', safe=True) == 0
+        if not up:
             self.logger.info('elasticsearch not yet up on all nodes')
-        return rc == 0
+        return up
+
+    def _local_http_check(self, fqdn):
+        response = _http_pool.request(
+            'HEAD', 'http://{fqdn}:9200/_cat/health'.format(fqdn=fqdn), timeout=2.0, retries=False)
+        return response.status == 200
 
     def upgrade_elasticsearch(self):
         self.upgrade_packages(['elasticsearch', 'wmf-elasticsearch-search-plugins'])
@@ -322,8 +400,8 @@ class ElasticNodes(Nodes):
 
 class ScriptNode(Nodes):
 
-    def __init__(self, fqdn, cumin_config, dry_run, icinga):
-        super(ScriptNode, self).__init__([fqdn], cumin_config, dry_run, icinga, sudo=False)
+    def __init__(self, fqdn, cumin_config, dry_run, icinga, fake_safe=False):
+        super().__init__([fqdn], cumin_config, dry_run, icinga, sudo=False, fake_safe=fake_safe)
 
     def mwscript(self, script, args, safe=False):
         args_string = ' '.join(args)
@@ -340,5 +418,5 @@ class ConfigError(Exception):
 class MaxWriteQueueExceeded(Exception):
 
     def __init__(self, queue_status, *args):
-        super(MaxWriteQueueExceeded, self).__init__(*args)
+        super().__init__(*args)
         self.queue_status = queue_status
@@ -1,4 +1,6 @@
 import logging
+import shlex
+import time
 from contextlib import contextmanager
 
 from cumin.transport import Transport
@@ -9,20 +11,43 @@ from cumin.transports import Target
 from estools.utils import wait_for
 
 
+_SERVICE_COMMAND = 'service {name} {action}'
+
+# never prompt, keep existing configuration files and only install what is required
+_APT_OPTIONS = ' '.join([
+    '-qq',
+    '-y',
+    '--no-install-recommends',
+    '-o Dpkg::Options::="--force-confdef"',
+    '-o Dpkg::Options::="--force-confold"',
+])
+
+_SSH_MULTIPLEXING_OPTIONS = [
+    '-o ControlMaster=auto',
+    '-o ControlPersist=10m',
+    '-o ControlPath=~/.ssh/cm-%r@%h:%p',
+]
+
+
 class RemoteExecutionError(Exception):
     pass
 
 
-class Nodes(object):
+class Nodes:
 
-    def __init__(self, fqdns, cumin_config, dry_run, icinga, sudo):
+    def __init__(self, fqdns, cumin_config, dry_run, icinga, sudo, fake_safe=False):
         assert isinstance(fqdns, list)
         self.fqdns = fqdns
+        self._hostnames = tuple(f.split('.', 1)[0] for f in fqdns)
         self._target = Target(fqdns)
-        self.cumin_config = cumin_config
+        self._worker = None
+        self._repr = None
+        self.cumin_config = _with_ssh_multiplexing(cumin_config)
         self.dry_run = dry_run
         self.icinga = icinga
         self.sudo = sudo
+        # in dry run, also skip safe commands and pretend they succeeded
+        self.fake_safe = fake_safe
         self.logger = logging.getLogger('estools.node')
 
     def __repr__(self):
@@ -32,19 +57,22 @@ class Nodes(object):
         >>> Nodes(['host1.example.net', 'host2.example.net', 'host3.example.net'], cumin_config={}, dry_run=True, icinga=None, sudo=False)
         Node(host[1-3].example.net)
         """
-        return 'Node({nodes})'.format(nodes=self._target.hosts)
+        # fqdns never change, compact the node set only once
+        if self._repr is None:
+            self._repr = 'Node({nodes})'.format(nodes=self._target.hosts)
+        return self._repr
 
     def hostnames(self):
         """
         >>> nodes = Nodes(['myhost.example.net', 'myotherhost.example.net'], cumin_config={}, dry_run=True, icinga=None, sudo=False)
         >>> nodes.hostnames()
-        ['myhost', 'myotherhost']
+        ('myhost', 'myotherhost')
         """
-        return [f.split('.')[0] for f in self.fqdns]
+        return self._hostnames
 
     def run_puppet_agent(self):
         self.logger.info('run puppet on %s', self)
-        self.execute('run-puppet-agent', safe=False)
+        self.execute_rc('run-puppet-agent', safe=False)
 
     def schedule_downtime(self, duration, message):
         self.icinga.downtime(self, duration, message)
@@ -59,50 +87,54 @@ class Nodes(object):
 
     def _disable_puppet(self, message):
         self.logger.info('disable puppet on %s', self)
-        self.execute('disable-puppet "{message}"'.format(message=message), safe=False)
+        self.execute_rc('disable-puppet "{message}"'.format(message=message), safe=False)
         if not self.dry_run and self.is_puppet_enabled():
             raise RemoteExecutionError('Puppet still enabled.')
 
     def _enable_puppet(self, message):
         self.logger.info('enable puppet on %s', self)
-        self.execute('enable-puppet "{message}"'.format(message=message), safe=False)
-        if not self.dry_run and not self.is_puppet_enabled():
+        # enable and check in the same run, puppet-enabled fails if puppet is still disabled
+        rc, _ = self.execute_batch(['enable-puppet "{message}"'.format(message=message), 'puppet-enabled'], safe=False)
+        if rc != 0:
             raise RemoteExecutionError('Puppet still disabled.')
 
     def is_puppet_enabled(self):
-        rc, message = self.execute('puppet-enabled', safe=True)
-        return rc == 0
+        return self.execute_rc('puppet-enabled', safe=True) == 0
 
     def depool(self):
         self.logger.info('depool %s', self)
         # ugly hack for sudo (which is already an ugly hack)
         if self.sudo:
-            self.execute('-i depool', safe=False)
+            self.execute_rc('-i depool', safe=False)
         else:
-            self.execute('depool', safe=False)
+            self.execute_rc('depool', safe=False)
 
     def pool(self):
         self.logger.info('pool %s', self)
         # ugly hack for sudo (which is already an ugly hack)
         if self.sudo:
-            self.execute('-i pool', safe=False)
+            self.execute_rc('-i pool', safe=False)
         else:
-            self.execute('pool', safe=False)
+            self.execute_rc('pool', safe=False)
 
     def stop_service(self, name):
         self.logger.info('stop service [%s] on %s', name, self)
-        self.execute('service {name} stop'.format(name=name), safe=False)
-        if self.is_service_running(name):
+        self.execute_rc(_SERVICE_COMMAND.format(name=name, action='stop'), safe=False)
+        if not self.dry_run and self.is_service_running(name):
             raise RemoteExecutionError('Service {name} is still running.'.format(name=name))
 
     def start_service(self, name):
         self.logger.info('start service [%s] on %s', name, self)
-        self.execute('service {name} start'.format(name=name), safe=False)
-        if not self.is_service_running(name):
+        # start and check in the same run, status fails if the service is not running
+        rc, _ = self.execute_batch([
+            _SERVICE_COMMAND.format(name=name, action='start'),
+            _SERVICE_COMMAND.format(name=name, action='status'),
+        ], safe=False)
+        if rc != 0:
             raise RemoteExecutionError('Service {name} is still stopped.'.format(name=name))
 
     def is_service_running(self, name):
-        rc, _ = self.execute('service {name} status'.format(name=name), safe=True)
+        rc = self.execute_rc(_SERVICE_COMMAND.format(name=name, action='status'), safe=True)
         if rc == 0:
             self.logger.info('service [%s] is running on %s', name, self)
         else:
@@ -111,85 +143,164 @@ class Nodes(object):
 
     def upgrade_packages(self, packages):
         self.logger.info('upgrade packages [%s] on %s', packages, self)
-        self.execute(
-            'apt-get {options} install {packages}'.format(
-                options='-o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold"',
+        self.execute_rc(
+            'env DEBIAN_FRONTEND=noninteractive apt-get {options} install {packages}'.format(
+                options=_APT_OPTIONS,
                 packages=' '.join(packages)
             ),
             safe=False)
 
     def max_uptime(self):
         def parse_uptime(message):
-            uptime_in_seconds = float(message.strip().split()[0])
-            return timedelta(seconds=uptime_in_seconds)
-
-        _, results = self.execute('cat /proc/uptime', safe=True, transform=parse_uptime)
-
-        for hosts, uptime in results:
-            self.logger.debug('uptime is [%s] on %s', uptime, hosts)
-        return max([uptime for _, uptime in results])
-
-    def wait_for_reboot(self, reboot_time, retry_period=timedelta(seconds=1), timeout=timedelta(minutes=10)):
+            return float(message.split(None, 1)[0])
+
+        _, results = self.execute_batch(['cat /proc/uptime'], safe=True, transform=parse_uptime, decode=False)
+
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        max_uptime_in_seconds = None
+        for hosts, uptime_in_seconds in results:
+            if debug:
+                self.logger.debug('uptime is [%s] seconds on %s', uptime_in_seconds, hosts)
+            if max_uptime_in_seconds is None or uptime_in_seconds > max_uptime_in_seconds:
+                max_uptime_in_seconds = uptime_in_seconds
+        if max_uptime_in_seconds is None:
+            raise ValueError('No uptime could be read on {nodes}'.format(nodes=self))
+        return timedelta(seconds=max_uptime_in_seconds)
+
+    def wait_for_reboot(self, reboot_time, initial_period=timedelta(seconds=1), max_period=timedelta(seconds=10),
+                        timeout=timedelta(minutes=10), grace_period=timedelta(seconds=30)):
         def check_uptime():
             return self.max_uptime() < datetime.utcnow() - reboot_time
 
+        # nodes are down for a while after a reboot, don't poll them during that time
+        grace_left = (reboot_time + grace_period - datetime.utcnow()).total_seconds()
+        if grace_left > 0:
+            time.sleep(grace_left)
+
         wait_for(
             check_uptime,
-            retry_period=retry_period,
             timeout=timeout,
-            ignored_exceptions=[RemoteExecutionError, ValueError]
+            ignored_exceptions=[RemoteExecutionError, ValueError],
+            initial_period=initial_period,
+            max_period=max_period,
+            error_initial_period=initial_period,
+            error_max_period=max_period
         )
 
     def reboot(self):
         self.logger.info('rebooting %s', self)
         reboot_time = datetime.utcnow()
 
-        self.execute('nohup reboot &> /dev/null & exit', safe=False)
+        self.execute_rc('nohup reboot &> /dev/null & exit', safe=False)
         if self.dry_run:
             # don't check, server has not been rebooted for real
             return
         self.wait_for_reboot(reboot_time)
 
     def drop_disk_cache(self):
-        self.execute('bash -c "echo 1 > /proc/sys/vm/drop_caches"', safe=False)
+        self.execute_rc('bash -c "echo 1 > /proc/sys/vm/drop_caches"', safe=False)
 
     def execute_single(self, command, safe):
         rc, results = self.execute(command, safe)
         # we executed on a single node, there should be a single result
-        for _, message in results:
-            return rc, message
+        _, message = next(iter(results), (None, ''))
+        return rc, message
 
-    def execute(self, command, safe, transform=lambda x: x):
-        self.logger.info('executing [%s] on %s', command, self)
+    def execute(self, command, safe, transform=None):
+        return self.execute_batch([command], safe, transform)
+
+    def execute_batch(self, commands, safe, transform=None, decode=True):
+        """Execute several commands in a single cumin run.
+
+        Each node runs the commands one after the other and stops at the first
+        failure, the return code is non zero if any command failed on any node.
+        With decode=False, transform receives the raw output as bytes.
+        """
+        self.logger.info('executing [%s] on %s', '; '.join(commands), self)
         if self.dry_run and not safe:
-            return 0, [(None, '')]
-        worker = Transport.new(self.cumin_config, self._target)
+            return 0, [(None, '' if decode else b'')]
+        if self.dry_run and self.fake_safe:
+            # '0.0 0.0' also reads as a freshly rebooted /proc/uptime
+            message = '0.0 0.0' if decode else b'0.0 0.0'
+            return 0, [(fqdn, transform(message) if transform else message) for fqdn in self.fqdns]
+
+        rc = self._run(commands)
+        # cumin results live in the ClusterShell task shared by the whole thread, the next
+        # command run on any nodes replaces them: read them all now
+        return rc, list(self._iter_results(transform, decode))
+
+    def _iter_results(self, transform, decode):
+        for host, result in self._worker.get_results():
+            message = result.message()
+            if decode:
+                message = message.decode('utf-8')
+            yield host, transform(message) if transform else message
+
+    def execute_rc(self, command, safe):
+        """Execute a command and only return its return code, the output is never collected."""
+        self.logger.info('executing [%s] on %s', command, self)
+        if self.dry_run and (not safe or self.fake_safe):
+            return 0
+        return self._run([command])
+
+    def _run(self, commands):
+        worker = self._get_worker()
         if self.sudo:
-            worker.commands = ['sudo ' + command]
+            worker.commands = ['sudo ' + command for command in commands]
         else:
-            worker.commands = [command]
-        worker.handler = 'sync'
-
-        rc = worker.execute()
-
-        return rc, [(host, transform(result.message().decode('utf-8'))) for host, result in worker.get_results()]
+            worker.commands = list(commands)
+        return worker.execute()
+
+    def _get_worker(self):
+        """Get the cumin worker for these nodes, created once and reused for every command."""
+        if self._worker is None:
+            # a single worker targets all nodes, cumin runs the command on all of them concurrently
+            self._worker = Transport.new(self.cumin_config, self._target)
+            # each host runs its commands independently, without waiting for the others between commands
+            self._worker.handler = 'async'
+        return self._worker
+
+
+def _with_ssh_multiplexing(cumin_config):
+    """Add OpenSSH connection multiplexing options to a copy of the cumin configuration.
+
+    Successive commands on the same host then reuse a single SSH connection
+    instead of doing a full handshake each time. Options already present in
+    the configuration take precedence.
+
+    >>> _with_ssh_multiplexing({'clustershell': {'ssh_options': ['-o ControlPersist=1m']}})['clustershell']
+    {'ssh_options': ['-o ControlPersist=1m', '-o ControlMaster=auto', '-o ControlPath=~/.ssh/cm-%r@%h:%p']}
+    """
+    if cumin_config is None:
+        return None
+    clustershell = dict(cumin_config.get('clustershell', {}))
+    ssh_options = list(clustershell.get('ssh_options', []))
+    for option in _SSH_MULTIPLEXING_OPTIONS:
+        name = option.split('=')[0].split()[-1]
+        if not any(name in existing for existing in ssh_options):
+            ssh_options.append(option)
+    clustershell['ssh_options'] = ssh_options
+    config = dict(cumin_config)
+    config['clustershell'] = clustershell
+    return config
 
 
 class Icinga(Nodes):
 
-    def __init__(self, fqdn, cumin_config, sudo, dry_run):
-        super(Icinga, self).__init__([fqdn], cumin_config, dry_run, self, sudo)
+    def __init__(self, fqdn, cumin_config, sudo, dry_run, fake_safe=False):
+        super().__init__([fqdn], cumin_config, dry_run, self, sudo, fake_safe)
         self.logger = logging.getLogger('estools.icinga')
 
     def downtime(self, nodes, duration, message):
         self.logger.info('scheduling downtime for %s', nodes)
 
-        for hostname in nodes.hostnames():
-            rc, _ = self.execute('icinga-downtime -h {hostname} -d {duration} -r "{message}"'.format(
-                hostname=hostname,
-                duration=int(duration.total_seconds()),
-                message=message
-            ), safe=False)
+        # downtime all hosts in a single remote command, run through bash so that sudo covers the whole loop
+        script = 'for hostname in {hostnames}; do icinga-downtime -h "$hostname" -d {duration} -r {message} || exit 1; done'.format(
+            hostnames=' '.join(nodes.hostnames()),
+            duration=int(duration.total_seconds()),
+            message=shlex.quote(message)
+        )
+        rc = self.execute_rc('bash -c {script}'.format(script=shlex.quote(script)), safe=False)
 
-            if rc != 0:
-                raise RemoteExecutionError('Could not downtime %s', nodes)
+        if rc != 0:
+            raise RemoteExecutionError('Could not downtime %s', nodes)
@@ -1,9 +1,9 @@
 import logging
 
-import yaml
 from elasticsearch import Elasticsearch
 
 from estools import Datacenter, ElasticsearchCluster
+from estools.utils import load_cumin_config
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('curator').setLevel(logging.WARNING)
@@ -11,8 +11,7 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 logging.getLogger('elasticsearch').setLevel(logging.ERROR)
 logging.getLogger('cumin').setLevel(logging.WARNING)
 
-with open('/home/gehel/.cumin/config.yaml', 'r') as f:
-    cumin_config = yaml.safe_load(f)
+cumin_config = load_cumin_config('/home/gehel/.cumin/config.yaml')
 
 es = Elasticsearch([{'host': 'localhost', 'port': 9200}])
 
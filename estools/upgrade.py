@@ -1,46 +1,51 @@
-from __future__ import print_function
-
 from dateutil import parser
 import logging
-import yaml
 from datetime import timedelta
-import time
+from functools import lru_cache
 
 from tqdm import tqdm
 
 from estools import Datacenter, ElasticNodes, MaxWriteQueueExceeded
-from estools.utils import TimeoutException, timer
+from estools.utils import TimeoutException, load_cumin_config, timer
 
-logging.basicConfig(level=logging.DEBUG, stream=tqdm)
+logger = logging.getLogger('estools.upgrade')
 
-logging.getLogger()
 
-logger = logging.getLogger('estools.upgrade')
-logging.getLogger('curator').setLevel(logging.WARNING)
-logging.getLogger('urllib3').setLevel(logging.WARNING)
-logging.getLogger('elasticsearch').setLevel(logging.ERROR)
-logging.getLogger('cumin').setLevel(logging.WARNING)
+@lru_cache(maxsize=None)
+def _bootstrap():
+    """Configure logging, once, on first use rather than on import."""
+    logging.basicConfig(level=logging.DEBUG, stream=tqdm)
+    logging.getLogger('curator').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+    logging.getLogger('elasticsearch').setLevel(logging.ERROR)
+    logging.getLogger('cumin').setLevel(logging.WARNING)
 
 
 def execute_on_cluster(message, phab_number, start_time, wait_for_relocations, task, parallelism=3, dry_run=True):
-    with open('/home/gehel/.cumin/config.yaml', 'r') as f:
-        cumin_config = yaml.safe_load(f)
+    _bootstrap()
+    cumin_config = load_cumin_config('/home/gehel/.cumin/config.yaml')
 
     formatted_message = '{message} - {phab_number}'.format(message=message, phab_number=phab_number)
 
-    dc = Datacenter(cumin_config, sudo=True, dry_run=dry_run)
+    dc = Datacenter(cumin_config, sudo=True, dry_run=dry_run, fake_safe=dry_run)
 
     cluster = dc.elasticsearch_cluster('test', 'local')
 
+    for nodes in iter_node_batches(cluster, start_time, parallelism):
+        execute_on_nodes(cluster, message, nodes, task, wait_for_relocations)
+
+
+def iter_node_batches(cluster, start_time, parallelism):
+    """Yield batches of nodes not yet restarted since start_time, until there are none left."""
     while True:
         nodes = cluster.next_nodes(start_time, n=parallelism)
         if not nodes:
-            break
-
-        execute_on_nodes(cluster, message, nodes, task, wait_for_relocations)
+            return
+        yield nodes
 
 
 def execute_on_nodes(cluster, message, nodes, task, wait_for_relocations):
+    _bootstrap()
     with timer('{message} on {nodes}'.format(message=message, nodes=nodes)):
 
         with timer('wait for green'):
@@ -50,8 +55,11 @@ def execute_on_nodes(cluster, message, nodes, task, wait_for_relocations):
             nodes.schedule_downtime(duration=timedelta(minutes=30), message=message)
 
             with cluster.frozen_writes():
-                logger.info('waiting for writes to settle')
-                time.sleep(60)
+                try:
+                    with timer('wait for writes to settle'):
+                        cluster.wait_for_write_queue_empty(timeout=timedelta(minutes=1))
+                except TimeoutException:
+                    logger.warning('Writes have not settled yet, continuing.')
 
                 with cluster.stopped_replication(wait_for_relocations):
                     cluster.flush_markers()
@@ -83,16 +91,12 @@ def execute_on_nodes(cluster, message, nodes, task, wait_for_relocations):
         # puppet enabled
 
         logger.info('waiting for cluster to stabilize before next node')
-        with timer('wait for green'):
-            cluster.wait_for_green(timeout=timedelta(minutes=90))
+        with timer('wait for cluster to stabilize'):
+            cluster.wait_for_stable(timeout=timedelta(minutes=90), require_no_relocations=wait_for_relocations)
 
         # with timer('wait for write queue to drain'):
         #     cluster.wait_for_write_queue_to_drain()
 
-        if wait_for_relocations:
-            with timer('wait for no relocation'):
-                cluster.wait_for_no_relocations(timeout=timedelta(minutes=20))
-
 
 def upgrade_nodes(nodes):
     logger.info('starting upgrade for %s', nodes)
@@ -1,28 +1,75 @@
-from __future__ import print_function
-
+import asyncio
+import inspect
 import logging
+import os
+import random
 import time
 from contextlib import contextmanager
+from functools import lru_cache
+
+import yaml
 
 from datetime import timedelta
 
 
-def wait_for(condition, timeout=timedelta(seconds=30), retry_period=timedelta(seconds=10), ignored_exceptions=[]):
-    """
+def wait_for(condition, timeout=timedelta(seconds=30), retry_period=timedelta(seconds=10), ignored_exceptions=(),
+             initial_period=None, max_period=None, jitter=True, backoff_factor=2.0,
+             error_initial_period=timedelta(seconds=1), error_max_period=timedelta(seconds=60), notify=None,
+             progress=None):
+    """Wait until condition() returns a truthy value.
+
+    timeout counts from the call, first check included, and no sleep goes
+    past it.
+
+    By default, condition is checked every retry_period. If initial_period is
+    given, an exponential backoff is used instead: the delay starts at
+    initial_period and is multiplied by backoff_factor after each check,
+    capped at max_period if given. With jitter, the actual sleep is drawn uniformly
+    in [0, delay]. A fixed retry_period is the same as a backoff starting
+    and capped at retry_period, without jitter.
+
+    When condition raises one of the ignored_exceptions, the next check is
+    delayed by an error backoff instead, starting at error_initial_period and
+    doubling on each consecutive error up to error_max_period, plus a random
+    jitter of up to the same amount. It is reset as soon as condition returns.
+
+    All durations can be given either as timedeltas or as numbers of seconds.
+
+    If notify is a threading.Event, waits between checks are cut short as
+    soon as it is set, so that whatever changes the state checked by
+    condition can trigger an immediate check.
+
+    progress, if given, is called without arguments after each unsuccessful
+    check, for example to show that the wait is still going on.
+
     >>> wait_for(
     ...     condition=lambda: True,
     ...     timeout=timedelta(seconds=2),
     ...     retry_period=timedelta(seconds=1))
-    >>> wait_for(
+    >>> wait_for(  # doctest: +IGNORE_EXCEPTION_DETAIL
     ...     condition=lambda: False,
     ...     timeout=timedelta(seconds=2),
     ...     retry_period=timedelta(seconds=1))
     Traceback (most recent call last):
       ...
     TimeoutException
+    >>> import threading
+    >>> event = threading.Event()
+    >>> event.set()
+    >>> checks = iter([False, True])
+    >>> wait_for(
+    ...     condition=lambda: next(checks),
+    ...     timeout=timedelta(seconds=2),
+    ...     retry_period=timedelta(seconds=10),
+    ...     notify=event)
+    >>> checks = iter([False, False, True])
+    >>> wait_for(
+    ...     condition=lambda: next(checks),
+    ...     timeout=timedelta(seconds=2),
+    ...     initial_period=timedelta(milliseconds=10))
     >>> def raise_key_error():
     ...     raise KeyError()
-    >>> wait_for(
+    >>> wait_for(  # doctest: +IGNORE_EXCEPTION_DETAIL
     ...     condition=raise_key_error,
     ...     timeout=timedelta(seconds=2),
     ...     retry_period=timedelta(seconds=1),
@@ -30,6 +77,14 @@ def wait_for(condition, timeout=timedelta(seconds=30), retry_period=timedelta(se
     Traceback (most recent call last):
       ...
     TimeoutException
+    >>> wait_for(  # doctest: +IGNORE_EXCEPTION_DETAIL
+    ...     condition=lambda: False,
+    ...     timeout=timedelta(seconds=2),
+    ...     initial_period=timedelta(milliseconds=100),
+    ...     max_period=timedelta(seconds=1))
+    Traceback (most recent call last):
+      ...
+    TimeoutException
     >>> wait_for(
     ...     condition=raise_key_error,
     ...     timeout=timedelta(seconds=2),
@@ -38,34 +93,176 @@ def wait_for(condition, timeout=timedelta(seconds=30), retry_period=timedelta(se
       ...
     KeyError
     """
-    assert isinstance(timeout, timedelta)
-    assert isinstance(retry_period, timedelta)
+    ignored = tuple(ignored_exceptions)
+    # the timeout includes the first check, long polling conditions can take a while
+    deadline = time.monotonic() + _to_seconds(timeout)
+    # most waits are already over on the first check, don't set anything else up for those
+    try:
+        if condition():
+            return
+        failed = False
+    except ignored:
+        failed = True
 
-    start_time = time.time()
+    # work with seconds from here on
+    if initial_period is None:
+        delay = max_delay = _to_seconds(retry_period)
+        jitter = False
+    else:
+        delay = _to_seconds(initial_period)
+        max_delay = _to_seconds(max_period) if max_period is not None else float('inf')
+    error_initial_delay = _to_seconds(error_initial_period)
+    error_max_delay = _to_seconds(error_max_period)
+    error_delay = error_initial_delay
     while True:
+        if failed:
+            sleep_seconds = error_delay + random.uniform(0, error_delay)
+            error_delay = min(error_max_delay, error_delay * 2)
+        else:
+            error_delay = error_initial_delay
+            sleep_seconds = random.uniform(0, delay) if jitter else delay
+            delay = min(max_delay, delay * backoff_factor)
+        # never sleep past the deadline, whatever the backoff
+        sleep_seconds = min(sleep_seconds, max(0, deadline - time.monotonic()))
+        if progress is not None:
+            progress()
+        if notify is not None:
+            notify.wait(sleep_seconds)
+            notify.clear()
+        else:
+            time.sleep(sleep_seconds)
+        if time.monotonic() > deadline:
+            raise TimeoutException()
         try:
             if condition():
                 return
-        except Exception as e:
-            search = [x for x in ignored_exceptions if isinstance(e, x)]
-            if len(search) == 0:
-                raise e
-        print('.', end='')
-        time.sleep(retry_period.total_seconds())
-        if time.time() > start_time + timeout.total_seconds():
-            raise TimeoutException()
+            failed = False
+        except ignored:
+            failed = True
+
+
+async def await_for(condition, timeout=timedelta(seconds=30), retry_period=timedelta(seconds=10),
+                    ignored_exceptions=()):
+    """Wait until condition() returns a truthy value, without blocking the event loop.
+
+    condition can be a plain function or a coroutine function. It is checked
+    every retry_period, ignoring the ignored_exceptions it raises.
+
+    >>> async def ready():
+    ...     return True
+    >>> asyncio.run(await_for(ready, timeout=timedelta(seconds=2), retry_period=timedelta(seconds=1)))
+    >>> asyncio.run(await_for(  # doctest: +IGNORE_EXCEPTION_DETAIL
+    ...     condition=lambda: False,
+    ...     timeout=timedelta(seconds=2),
+    ...     retry_period=timedelta(seconds=1)))
+    Traceback (most recent call last):
+      ...
+    TimeoutException
+    >>> def read():
+    ...     raise TimeoutError('read timed out')
+    >>> asyncio.run(await_for(read, timeout=timedelta(seconds=30)))
+    Traceback (most recent call last):
+      ...
+    TimeoutError: read timed out
+    """
+    ignored = tuple(ignored_exceptions)
+    retry_seconds = _to_seconds(retry_period)
+
+    async def poll():
+        while True:
+            try:
+                result = condition()
+                if inspect.isawaitable(result):
+                    result = await result
+                if result:
+                    return
+            except ignored:
+                pass
+            await asyncio.sleep(retry_seconds)
+
+    # only the deadline expiring is a TimeoutException, a TimeoutError raised
+    # by condition (a network read timing out, ...) is propagated as is
+    if hasattr(asyncio, 'timeout'):
+        # asyncio.timeout() is only available from python 3.11
+        deadline = asyncio.timeout(_to_seconds(timeout))
+        try:
+            async with deadline:
+                await poll()
+        except TimeoutError:
+            if not deadline.expired():
+                raise
+            raise TimeoutException() from None
+    else:
+        task = asyncio.ensure_future(poll())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=_to_seconds(timeout))
+            if not done:
+                raise TimeoutException()
+            task.result()
+        finally:
+            task.cancel()
+
+
+def _to_seconds(duration):
+    """
+    >>> _to_seconds(timedelta(minutes=1))
+    60.0
+    >>> _to_seconds(2)
+    2.0
+    """
+    if isinstance(duration, timedelta):
+        return duration.total_seconds()
+    return float(duration)
+
+
+def shuffled(items):
+    """Iterate over items in random order, picking each one as it is consumed.
+
+    This is a lazy Fisher-Yates shuffle: when only the first few items are
+    used, the rest of the permutation is never computed. items is not modified.
+
+    >>> sorted(shuffled([3, 1, 2]))
+    [1, 2, 3]
+    >>> list(shuffled([]))
+    []
+    """
+    items = list(items)
+    for i in range(len(items) - 1, -1, -1):
+        j = random.randint(0, i)
+        items[i], items[j] = items[j], items[i]
+        yield items[i]
+
+
+# the LibYAML based loader is much faster, but is not always available
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_cumin_config(path):
+    """Load a cumin configuration file, parsing it again only if it has been modified."""
+    return _load_yaml(path, os.path.getmtime(path))
+
+
+@lru_cache(maxsize=None)
+def _load_yaml(path, mtime):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+_TIMER_LOGGER = logging.getLogger('estools.timer')
 
 
 @contextmanager
 def timer(message):
-    start_time = time.time()
+    # durations are only ever logged at debug level, don't measure them if they would be dropped
+    if not _TIMER_LOGGER.isEnabledFor(logging.DEBUG):
+        yield
+        return
+    start_time = time.perf_counter()
     try:
         yield
     finally:
-        end_time = time.time()
-        logger = logging.getLogger('estools.timer')
-        duration_in_seconds = end_time - start_time
-        logger.debug('%s took %s seconds', message, duration_in_seconds)
+        duration_in_seconds = time.perf_counter() - start_time
+        _TIMER_LOGGER.debug('%s took %s seconds', message, duration_in_seconds)
 
 
 class TimeoutException(Exception):
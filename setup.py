@@ -8,17 +8,23 @@ setup(name='estools',
       author_email='guillaume.lederrey@wikimedia.org',
       license='Apache',
       packages=['estools'],
-      python_requires='>=3',
+      python_requires='>=3.9',
       install_requires=[
             'cumin == 3.0.1',
             'python-dateutil',
             'pyyaml',
             'tqdm',
+            'urllib3',
             'elasticsearch>=5.0.0,<6.0.0',
             'elasticsearch-curator>=5.0.0,<6.0.0',
-            'git+ssh://git@github.com/wikimedia/operations-switchdc.git#egg=switchdc',
-            'virtualfish',
-            'freezegun',
-            'mock'
       ],
+      extras_require={
+            'test': [
+                  'freezegun',
+                  'mock',
+            ],
+            'dev': [
+                  'virtualfish',
+            ],
+      },
       zip_safe=False)